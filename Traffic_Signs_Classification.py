@@ -19,6 +19,7 @@ import seaborn as sns
 
 # Using pickle package to open our data, not much use after that
 import pickle
+import os # Used to check whether we have already converted the pickled data
 
 
 """
@@ -30,27 +31,30 @@ the network validation data every epoch (or run) in a process called
 cross-validation to ensure that the network is not focusing on the details of the
 training data. 
 """
-with open("./traffic-signs-data/train.p", mode = 'rb') as training_data:
-  train = pickle.load(training_data) # Use pickle's load method to load the defined data as the variable test
+data_dir = "./traffic-signs-data" # The folder with the pickled dataset files, the converted .npy files are saved next to them
 
-with open("./traffic-signs-data/valid.p", mode = 'rb') as validation_data:
-  valid = pickle.load(validation_data)
-
-with open("./traffic-signs-data/test.p", mode = 'rb') as testing_data:
-  test = pickle.load(testing_data)
+def load_split(name):
+  features_path = os.path.join(data_dir, "{}_X.npy".format(name))
+  labels_path = os.path.join(data_dir, "{}_y.npy".format(name))
+  if not os.path.exists(labels_path): # Only the very first run has to unpickle the data, every run after that reads the converted .npy files
+    with open(os.path.join(data_dir, "{}.p".format(name)), mode = 'rb') as pickled_data:
+      data = pickle.load(pickled_data) # Use pickle's load method to load the defined data
+    np.save(features_path, data['features'])
+    np.save(labels_path, data['labels'].astype(np.int32)) # Storing the labels as 32-bit integers, which is what the sparse categorical cross entropy loss works with. The labels are saved last so an interrupted conversion gets redone on the next run
+  return np.load(features_path, mmap_mode = 'r'), np.load(labels_path) # Memory-mapping the images means numpy does not read the whole file up front, the operating system pages the images in as we use them (and keeps them cached between runs)
 
 
 """
 Splitting the data into our individual training and testing set variables.
 """
 # Assigning the features of the training set as X_train and the dependent variable (labels) as y_train
-X_train, y_train = train['features'], train['labels']
+X_train, y_train = load_split('train')
 
 # Assigning the features of the validation set as X_validation and the dependent variable (labels) as y_validation
-X_validation, y_validation = valid['features'], valid['labels']
+X_validation, y_validation = load_split('valid')
 
 # Assigning the features of the testing set as X_test and the dependent variable (labels) as y_test
-X_test, y_test = test['features'], test['labels']
+X_test, y_test = load_split('test')
 
 # Checking the dimensions of the training set
 X_train.shape # Gives us an output of a four element tuple. The first number is the quantity of images, the second is the width of image in pixels, the third is the height of the image, and the last number the depth - in this case the 3 tells us that the images are colored since they are being multiplied for both Red, Green, and Blue
@@ -68,16 +72,25 @@ Using matplotlib to display a randomly choosen image and see if it matches with
 label, just to see what the images are and how the network will be classifying them. 
 Each type of sign has its own class which will identify the type of sign to the 
 model. 
+
+Drawing these previews creates a new matplotlib figure every time, which is wasted 
+work (and memory) when we just want to train the network, so they are only shown 
+when the script is run with the PREVIEW environment variable set to 1, for example 
+PREVIEW=1 python Traffic_Signs_Classification.py
 """
+def preview(image, **kwargs):
+  if os.environ.get('PREVIEW', '') not in ('', '0'): # Any value other than empty or 0 turns the previews on
+    plt.imshow(image, **kwargs) # Using matplotlib's .imshow method to show the image, any extra parameters such as cmap are passed along to it
+
 i = 23 # The index of the image we want to look at, arbitrarily chose 23
 
-plt.imshow(X_train[i]) # Using matplotlib's .imshow method to show an image from the features training set at the index of 23
+preview(X_train[i]) # Showing an image from the features training set at the index of 23
 y_train[i] # Also show us the corresponding label from the same index in the label's training set - the label tells us that the sign is a "End of No Passing"
 
-plt.imshow(X_validation[i]) # Verifying images for the validation dataset
+preview(X_validation[i]) # Verifying images for the validation dataset
 y_validation[i]
 
-plt.imshwo(X_test[i]) # Verifying images for the testing dataset
+preview(X_test[i]) # Verifying images for the testing dataset
 y_test[i]
 
 
@@ -91,34 +104,64 @@ in a certain order, we do not want the network to learn the order of these image
 We want to make it as hard as possible for the network to learn, which is why we
 use low-quality images, more restricted pixel range, and grayscale images. 
 """
-# Shuffling the dataset
-from sklearn.utils import shuffle # Importing the shuffle function from the sci-kit learn library to shuffle the dataset first
-X_train, y_train = shuffle(X_train, y_train) # Used the shuffle function to reassign the variables of X_train and y_train into a different order, however the labels still correspond to the correct images because the shuffle function reorders them the same way
-
-# Converting images to Grayscale
-X_train_gray = np.sum(X_train / 3, axis = 3, keepdims = True) # Use numpy to average the pixels to get the grayscale version of the image. We will simply add the pixel values from the three color channels (Red, Green, and Blue) and then divide them by 3. 
-X_train_gray.shape # The depth of the features training set is no longer 3, its now 1. This means the images are now grayscale
-plt.imshow(X_train_gray[i].squeeze(), cmap = 'gray') # The network will now learn from this "grayscale" image which uses much less processing power because the image depth is reduced to 1
-
-X_validation_gray = np.sum(X_validation/3, axis = 3, keepdims = True)
-X_validation_gray.shape # Averaging the RGB values to reduce the depth from 3 to 1 for the feature's validation set
-plt.imshow(X_validation_gray[i].squeeze(), cmap = 'gray') # Grayscale sample image from the feature's validation set
-
-X_test_gray = np.sum(X_test/3, axis = 3, keepdims = True)
-X_test_gray.shape 
-plt.imshow(X_test_gray[i].squeeze(), cmap = 'gray')
-
-# Restrict the pixel value scale for each dataset, aka normalization. Normalization is important because we want all our pixels in a similar range so the weight at one part of the image is not a lot more than the weight at another part of an image.
-X_train_gray_norm = (X_train_gray - 128) / 128 # There are many kinds of normalization methods. This one works by subtracting the image pixels by 128 because we want to center the data from its range of 0 to 255 (256 total, so half is 128). We then divide by 128 to put all the data between -1 and 1.
-# X_train_gray_norm ~ confirms that all the pixel values are between -1 and 1
-plt.imshow(X_train_gray_norm[i].squeeze(), cmap = 'gray') # The .squeeze() method gets rid of the 1 (last number) at the end of our tuple when we call the .shape method. This is because the 1 represented the depth of each image, but because our images are now grayscale we no longer need to include that. We are also specifying that we want our colormap, or cmap, to be in grayscale so we give it the 'gray' value.
-
-X_validation_gray_norm = (X_validation_gray - 128) / 128
-plt.imshow(X_validation_gray_norm[i].squeeze(), cmap = 'gray')
-
-X_test_gray_norm = (X_test_gray - 128) / 128
-plt.imshow(X_test_gray_norm[i].squeeze(), cmap = 'gray')
-
+# Converting images to Grayscale and normalizing them in a single pass
+try:
+  import pyximport # pyximport compiles Cython files the first time they are imported and reuses the compiled module on every run after that
+  pyximport.install(language_level = 3, build_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.pyxbld')) # Keeping the compiled kernel in a .pyxbld folder next to this script, rather than the ~/.pyxbld folder shared by every project, so a different project's prep.pyx can never be loaded in its place
+  from prep import prep_kernel # Our grayscale and normalization loop, written in Cython in prep.pyx. It reads every pixel once, adds the three color channels (Red, Green, and Blue), and writes the centered grayscale pixel, spreading the images across all CPU cores
+except ImportError as error: # Cython is not installed or there is no C compiler to build prep.pyx with
+  print("Could not build the Cython kernel in prep.pyx ({}), preparing the images with numpy instead".format(error))
+  prep_kernel = None
+
+def prep(x):
+  out = np.empty(x.shape[:3] + (1,), dtype = np.int8) # Allocating the int8 output up front so the kernel reads every pixel once and writes every result once, without any temporary arrays in between. Allocating it with the depth of 1 already in place gives us a contiguous channels-last (NHWC) array where the depth axis has a real stride of 1 byte, instead of the 0 stride that adding the axis afterwards with [..., None] would give it
+  if prep_kernel is not None:
+    prep_kernel(np.ascontiguousarray(x), out)
+  else:
+    weights = np.full(3, 1.0 / 3, dtype = np.float32) # Without the compiled kernel we do the same steps with numpy. Each of the three color channels (Red, Green, and Blue) counts for a third of the grayscale pixel
+    gray = np.einsum('nhwc,c->nhw', x, weights, dtype = np.float32) # Averaging the three color channels with a single einsum call. einsum converts the 8-bit pixels to float32 a chunk at a time as it reduces them, so there is no full-size float copy of the images (and no float64 at all)
+    np.rint(gray, out = gray) # Rounding to the nearest whole number gives us the grayscale pixel from 0 to 255
+    gray -= 128 # Subtracting 128 centers it between -128 and 127. That range fits exactly in an 8-bit integer, so each pixel takes 1 byte instead of the 4 bytes of a float32
+    out[..., 0] = gray
+  return out
+
+# Restrict the pixel value scale for each dataset, aka normalization. Normalization is important because we want all our pixels in a similar range so the weight at one part of the image is not a lot more than the weight at another part of an image. This one works by subtracting the image pixels by 128 because we want to center the data from its range of 0 to 255 (256 total, so half is 128). We then divide by 128 to put all the data between -1 and 1. The divide by 128 is done by the first layer of the network (see the Rescaling layer below), so the images we store and send to the network stay 8-bit integers which are 4 times smaller than float32.
+n_train, n_validation = len(X_train), len(X_validation) # Remembering how many images are in each split so we can separate them again afterwards
+X_all_gray_norm = prep(np.concatenate([X_train, X_validation, X_test], axis = 0)) # Instead of running the same steps three times, we stack all three datasets into one contiguous array and prepare every image with a single call
+X_train_gray_norm = X_all_gray_norm[:n_train] # Splitting the prepared images back into training, validation, and testing sets. These are just views into the same array so nothing gets copied
+X_validation_gray_norm = X_all_gray_norm[n_train:n_train + n_validation]
+X_test_gray_norm = X_all_gray_norm[n_train + n_validation:]
+
+X_train_gray_norm.shape # The depth of the features training set is no longer 3, its now 1. This means the images are now grayscale
+X_train_gray_norm.strides # Confirms the layout is contiguous channels-last: the strides are (1024, 32, 1, 1), so neighbouring pixels in a row are 1 byte (one int8) apart, each row is 32 pixels long, and the depth axis steps by one int8 as well
+# X_train_gray_norm ~ confirms that all the pixel values are between -128 and 127, the network divides them by 128 to put them between -1 and 1
+preview(X_train_gray_norm[i].squeeze(), cmap = 'gray') # The .squeeze() method gets rid of the 1 (last number) at the end of our tuple when we call the .shape method. This is because the 1 represented the depth of each image, but because our images are now grayscale we no longer need to include that. We are also specifying that we want our colormap, or cmap, to be in grayscale so we give it the 'gray' value.
+
+X_validation_gray_norm.shape # The depth of the features validation set is now 1 as well
+preview(X_validation_gray_norm[i].squeeze(), cmap = 'gray')
+
+X_test_gray_norm.shape
+preview(X_test_gray_norm[i].squeeze(), cmap = 'gray')
+
+# Shuffling the dataset. The training images are stored grouped by class, so we shuffle them once here, in place, with the Fisher-Yates algorithm: walking backwards through the images and swapping each one with a randomly chosen image that comes before it (or itself). Swapping in place means we never need a second, reordered copy of the whole training set like sklearn's shuffle function would create
+rng = np.random.default_rng() # NumPy's random number generator. Giving it a seed, for example np.random.default_rng(42), makes the shuffle the same on every run
+
+def shuffle_in_place(X, y):
+  row = np.empty_like(X[0]) # A single image-sized buffer that we reuse for every swap
+  for i in range(len(X) - 1, 0, -1):
+    j = rng.integers(0, i + 1)
+    row[:] = X[i]
+    X[i] = X[j]
+    X[j] = row
+    y[i], y[j] = y[j], y[i] # Swapping the labels the same way so they still correspond to the correct images
+
+shuffle_in_place(X_train_gray_norm, y_train) # The order the batches are visited in still changes every epoch on top of this (see make_dataset below)
+
+# Freeing the original color images now that we have the prepared grayscale ones, so only the images the network actually uses stay in memory while we train
+X_test_samples = np.array(X_test[:25]) # Keeping a copy of the first 25 color test images for the plot of predictions at the end
+del X_train, X_validation, X_test
+import gc # Python's garbage collector
+gc.collect() # Making sure the memory of the deleted arrays is given back right away
 
 """
 To train the model we will implement six fundamental steps that will ensure we have
@@ -160,15 +203,27 @@ the feature map by 2. This means the output depth will remain the same (the outp
 from the filters is still maintained), however the size of the output will be 
 divided from 28 to 14. The result of the pooling layer is 14 x 14 x 6.
 """
+# Turning on TensorFlow's oneDNN (MKL-DNN) kernels, which use the AVX2/AVX-512 and FMA instructions of modern CPUs for the convolutions. Newer TensorFlow versions already do this by default on Linux, but older ones need to be told before TensorFlow is first imported
+os.environ.setdefault('TF_ENABLE_ONEDNN_OPTS', '1')
+
 # Importing the Keras classes
 from keras.models import Sequential # We are going to use Keras which will sit on top of TensorFlow and help us build our network. From the keras.models module we will import the Sequential class which will allow us to build our network in a sequential fashion (building it one step at a time).
+from keras.layers import Input, Rescaling # The Input class tells the network the shape and type of the images it will recieve. The Rescaling class multiplies its input by a constant, which we use to finish normalizing the images inside the network
 from keras.layers import Conv2D, MaxPooling2D, AveragePooling2D, Dense, Flatten, Dropout # The Conv2D class will be used to perform our convolutions in the convolutional layers. The MaxPooling2D class is going to help us in the downsampling layers by selecting the largest pixel value in the pooling window. AveragePooling2D will also perform downsampling but it wil take the average of the pixels in the pooling window. Dense class helps build the dense layers. The Flatten class will help us flatten the matrix down to a vector of pixels. The Dropout class is implements a regularization technique that reduces overfitting by forcing some of the neurons to have an input of zero - which reduces dependency on any one feature.
 from keras.optimizers import Adam # The Adam class is optimization algorithm used to update the weights of the neural network. Adam maintains a running average of the gradients and uses them to update the model.
 from keras.callbacks import TensorBoard # We are basically using TensorFlow as the backend of the Keras API
+import tensorflow as tf # Importing TensorFlow itself so we can use its tf.data module to feed the training images to the network
+from keras import mixed_precision # Lets the layers compute in 16-bit floats while the weights stay in 32-bit floats
+
+# Using mixed precision when we have a GPU. The images going into the network are between -1 and 1 and easily fit in 16-bit floats, and the GPU's tensor cores run float16 convolutions and matrix multiplications about twice as fast as float32 while the activations take half the memory. CPUs mostly do not have fast float16 math, so there we keep the default float32
+if tf.config.list_physical_devices('GPU'):
+  mixed_precision.set_global_policy('mixed_float16')
 
 # Applying the First Convolution
 cnn_model = Sequential() # Create the Sequential class instance object
-cnn_model.add(Conv2D(filters = 6, kernel_size = (5,5), activation = 'relu', input_shape = (32, 32, 1))) # Use the Sequential class .add method to start building. The Conv2D is class is then called to build the first convolution layer, it takes 4 parameters. The first parameter is the number of filters which we know is 6. The kernel_size is the size of the filters which we know is 5 x 5 so we input the tuple (5,5). We specify the activation function as 'relu' to ensure ReLU is used. The final parameter is the input shape which will be the shape of the image so the tuple (32, 32, 1)
+cnn_model.add(Input(shape = (32, 32, 1), dtype = 'int8')) # Use the Sequential class .add method to start building. The input shape will be the shape of the image so the tuple (32, 32, 1), and the images arrive as the 8-bit integers we prepared earlier
+cnn_model.add(Rescaling(1.0 / 128)) # Dividing the pixels by 128 to put them between -1 and 1. Because this happens inside the network it runs on the same device as the rest of the model (the GPU if we have one), so only 1 byte per pixel has to be copied over instead of 4
+cnn_model.add(Conv2D(filters = 6, kernel_size = (5,5), activation = 'relu')) # The Conv2D is class is then called to build the first convolution layer, it takes 3 parameters. The first parameter is the number of filters which we know is 6. The kernel_size is the size of the filters which we know is 5 x 5 so we input the tuple (5,5). We specify the activation function as 'relu' to ensure ReLU is used.
 
 # Applying Pooling
 cnn_model.add(AveragePooling2D()) # Using the .add method from the Sequential class, call the AveragePooling2D class which will automatically apply average downsampling (average pixel value is chosen from pooling window) to our output. This means our output will go from (28, 28, 6) to (14, 14, 6). It will divide the image shape by 2 but will not affect the output depth.
@@ -257,7 +312,7 @@ handwritten digits 0 to 9. However, we are trying to classify 43 different kinds
 signs so our output layer needs to have 43 nodes. One node for each class.
 """
 # Building the last Dense layer
-cnn_model.add(Dense(units = 43, activation = 'softmax')) # The activation function of the last layer can't use ReLU because the output needs to be categorical (ReLU just gives us numbers that aren't negatives). The softmax activation function takes in all the input and squashes it between 0 and 1, meaning the final values of all the numbers add up to 1. These numbers between 0 and 1 act as probability values (if you multiply by 100 you get the percentage) which is perfect for our project.
+cnn_model.add(Dense(units = 43, activation = 'softmax', dtype = 'float32')) # The activation function of the last layer can't use ReLU because the output needs to be categorical (ReLU just gives us numbers that aren't negatives). The softmax activation function takes in all the input and squashes it between 0 and 1, meaning the final values of all the numbers add up to 1. These numbers between 0 and 1 act as probability values (if you multiply by 100 you get the percentage) which is perfect for our project. We keep this last layer in float32 even when using mixed precision so the probabilities and the loss are computed accurately.
 
 
 """
@@ -287,14 +342,35 @@ cnn_model.compile(loss = 'sparse_categorical_crossentropy', optimizer = Adam(lea
 Finally, to train the model we will use the .fit method from the Sequential class. 
 This class has a number of parameters that we will need to address for the network 
 to train effeciently, such as: features training dataset, dependent variable 
-training dataset, batch_size, nb_epoch, verbose, validation_data.
+training dataset, nb_epoch, verbose, validation_data.
 """
-history = cnn_model.fit(X_train_gray_norm, # The first parameter of the .fit method is the features training dataset. Here we will just input the features training data which are the images that we prepared by shuffling, grayscaling, and normalizing. The images are stored in the variable X_train_gray_norm
-              y_train, # The second parameter is the dependent varible training dataset (what we want to predict). We can just input the dependent variable training data which are the labels that correspond to every image in the features training data. These labels are stored in the variable y_train
-              batch_size = 500, # The third parameter is the batch_size with just means the number of images that will be fed into the network at once.
-              epochs = 5, # The fourth parameter is the epochs which means the number of epochs or a single pass through the entire dataset. At the end of each epoch, the model's performance is evaluated and recorded. Another epoch starts and the optimizer aims to perform better each time using the evaluations.
-              verbose = 1, # The fifth parameter is verbose which just means how much information the program shows us during the training process. Setting the value to 1 will show us all the background information, and the value will 0 will show us nothing.
-              validation_data = (X_validation_gray_norm, y_validation)) # The sixth parameter is the validation_data. This is the dataset we will use to avoid overfitting by showing the network validation data every epoch so that the network is not focusing on the details of the training data. The validation images are stored in the variable X_validation_gray_norm and the validation labels are stored in the variable y_validation
+batch_size = 500 # The batch_size just means the number of images that will be fed into the network at once.
+
+def make_dataset(X, y, batch_size):
+  def gather(k):
+    start = k * batch_size
+    return X[start:start + batch_size], y[start:start + batch_size] # Every batch is a contiguous slice of the training set, so assembling it is a straight memory copy instead of picking images from all over the array
+
+  def gather_batch(k):
+    images, labels = tf.numpy_function(gather, [k], (tf.as_dtype(X.dtype), tf.as_dtype(y.dtype))) # Running our numpy slicing inside the tf.data pipeline
+    images.set_shape((None,) + X.shape[1:]) # tf.numpy_function cannot know the shapes of what our function returns, so we tell TensorFlow what they are
+    labels.set_shape((None,))
+    return images, labels
+
+  n_batches = (len(X) + batch_size - 1) // batch_size # The number of batches in one epoch, the last batch holds whatever images are left over
+  dataset = tf.data.Dataset.range(n_batches) # A stream of the batch numbers 0, 1, 2, ...
+  dataset = dataset.shuffle(n_batches, reshuffle_each_iteration = True) # The training set was already shuffled once in place, so every epoch we only need to shuffle the order the batches are visited in, with a fresh order every epoch. That is one shuffle per batch instead of one per image
+  dataset = dataset.map(gather_batch, num_parallel_calls = tf.data.AUTOTUNE) # Gathering several upcoming batches at the same time on background threads, so the next batch is already assembled (and on its way to the device) while the network trains on the current one
+  if tf.config.list_physical_devices('GPU'):
+    return dataset.apply(tf.data.experimental.prefetch_to_device('/gpu:0')) # When training on a GPU, the next batches are copied into GPU memory in the background (through page-locked host memory) while the network is still working on the current batch
+  return dataset.prefetch(tf.data.AUTOTUNE) # On a CPU we still prepare the next batches in the background while the network trains on the current one
+
+train_dataset = make_dataset(X_train_gray_norm, y_train, batch_size) # The training images we prepared by grayscaling and normalizing, along with the labels that correspond to them
+
+history = cnn_model.fit(train_dataset, # The first parameter of the .fit method is the training data. Here we give it the dataset of shuffled batches which contains both the features (the images) and the dependent variable (the labels we want to predict), so we no longer pass y_train or batch_size separately.
+              epochs = 5, # The second parameter is the epochs which means the number of epochs or a single pass through the entire dataset. At the end of each epoch, the model's performance is evaluated and recorded. Another epoch starts and the optimizer aims to perform better each time using the evaluations.
+              verbose = 1, # The third parameter is verbose which just means how much information the program shows us during the training process. Setting the value to 1 will show us all the background information, and the value will 0 will show us nothing.
+              validation_data = (X_validation_gray_norm, y_validation)) # The fourth parameter is the validation_data. This is the dataset we will use to avoid overfitting by showing the network validation data every epoch so that the network is not focusing on the details of the training data. The validation images are stored in the variable X_validation_gray_norm and the validation labels are stored in the variable y_validation
 
 
 """
@@ -432,6 +508,6 @@ fig, axes = plt.subplots(length, width, figsize = (25, 25))
 axes = axes.ravel()
 
 for i in np.arange(0, length * width):
-  axes[i].imshow(X_test[i])
+  axes[i].imshow(X_test_samples[i])
   axes[i].set_title('Predictions = {}, True = {}'.format(classes_x[i], y_true[i]))
   axes[i].axis('off')
\ No newline at end of file
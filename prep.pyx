@@ -0,0 +1,23 @@
+"""
+The grayscale and normalization kernel for the Traffic Signs Classification project,
+compiled ahead of time with Cython. pyximport builds it the first time the project
+script runs (using the flags in prep.pyxbld) and reuses the compiled module after that.
+"""
+cimport cython
+from cython.parallel import prange
+
+
+@cython.boundscheck(False) # Skipping the index checks, every index below is inside the arrays
+@cython.wraparound(False) # We never use negative indices
+def prep_kernel(const unsigned char[:, :, :, ::1] x, signed char[:, :, :, ::1] out):
+  cdef Py_ssize_t n, i, j
+  cdef int s
+  if x.shape[3] != 3: # Bounds checking is turned off, so we check the shapes here instead of reading or writing past the end of the arrays
+    raise ValueError("prep_kernel expects RGB images with 3 color channels, got {}".format(x.shape[3]))
+  if out.shape[0] != x.shape[0] or out.shape[1] != x.shape[1] or out.shape[2] != x.shape[2] or out.shape[3] != 1:
+    raise ValueError("prep_kernel expects out to have shape {}, got {}".format((x.shape[0], x.shape[1], x.shape[2], 1), (out.shape[0], out.shape[1], out.shape[2], out.shape[3])))
+  for n in prange(x.shape[0], nogil = True): # prange spreads the images across all CPU cores with OpenMP
+    for i in range(x.shape[1]):
+      for j in range(x.shape[2]):
+        s = x[n, i, j, 0] + x[n, i, j, 1] + x[n, i, j, 2] # Adding the three color channels (Red, Green, and Blue) together
+        out[n, i, j, 0] = ((s * 683 + 1024) >> 11) - 128 # Rounding the sum divided by 3 with a multiply and shift, then centering the grayscale pixel between -128 and 127